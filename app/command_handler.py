@@ -3,12 +3,20 @@ from __future__ import annotations
 import asyncio
 import base64
 import contextlib
-import datetime
+import time
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING, Any, AsyncGenerator
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Mapping
 
 from app.exception import RedisError
-from app.redis_serde import BulkString, ErrorString, Message, RDBString, SimpleString
+from app.redis_serde import (
+    BulkString,
+    ErrorString,
+    Message,
+    RDBString,
+    RedisSerializer,
+    SimpleString,
+)
 from app.schemas import Connection, EntryId, StorageValue, StreamTrigger, WaitTrigger
 from app.storage import Storage, Stream
 from app.utils import to_pairs
@@ -16,49 +24,71 @@ from app.utils import to_pairs
 if TYPE_CHECKING:
     from app.server import RedisServer
 
-default_rdb = base64.b64decode(
-    "UkVESVMwMDEx+glyZWRpcy12ZXIFNy4yLjD6CnJlZGlzLWJpdHPAQPoFY3RpbWXCbQi8ZfoIdXNlZC1tZW3CsMQQAPoIYW9mLWJhc2XAAP/wbjv+wP9aog=="
+_SERIALIZER = RedisSerializer()
+
+_DEFAULT_RDB = _SERIALIZER.serialize(
+    RDBString(
+        base64.b64decode(
+            "UkVESVMwMDEx+glyZWRpcy12ZXIFNy4yLjD6CnJlZGlzLWJpdHPAQPoFY3RpbWXCbQi8ZfoIdXNlZC1tZW3CsMQQAPoIYW9mLWJhc2XAAP/wbjv+wP9aog=="
+        )
+    )
 )
+# Constant replies are stored pre-encoded; the serializer passes plain bytes through.
+_PONG = b"+PONG\r\n"
+_OK = b"+OK\r\n"
+_NULL = b"$-1\r\n"
+_TYPE_STRING = b"+string\r\n"
+_TYPE_STREAM = b"+stream\r\n"
+_TYPE_NONE = b"+none\r\n"
+_TYPE_TABLE = {
+    str: _TYPE_STRING,
+    BulkString: _TYPE_STRING,
+    int: _TYPE_STRING,
+    Stream: _TYPE_STREAM,
+}
+_REPLCONF_BS = BulkString("REPLCONF")
+_ACK_BS = BulkString("ACK")
+_GETACK_BS = BulkString("GETACK")
+_STAR_BS = BulkString("*")
+_GETACK_WIRE = _SERIALIZER.serialize([_REPLCONF_BS, _GETACK_BS, _STAR_BS])
+
+_ERR_UNKNOWN_COMMAND = b"-ERR Unknown command\r\n"
+_ERR_SET_ARGS = b"-ERR Wrong number of arguments for 'set' command\r\n"
+_ERR_GET_ARGS = b"-ERR Wrong number of arguments for 'get' command\r\n"
+_ERR_XADD_ARGS = b"-ERR Wrong number of arguments for 'xadd' command\r\n"
+_ERR_XRANGE_ARGS = b"-ERR Wrong number of arguments for 'xrange' command\r\n"
+_ERR_XREAD_ARGS = b"-ERR Wrong number of arguments for 'xread' command\r\n"
+_ERR_INFO_ARGS = b"-ERR Wrong arguments for 'info' command\r\n"
+_ERR_REPLCONF_ARGS = b"-ERR Wrong arguments for 'replconf' command\r\n"
+_ERR_PSYNC_ARGS = b"-ERR Wrong arguments for 'psync' command\r\n"
+_ERR_NOT_MASTER = b"-ERR Only available for master\r\n"
+_ERR_WAIT_ARGS = b"-ERR Wrong arguments for 'wait' command\r\n"
+_ERR_CONFIG_ARGS = b"-ERR Wrong arguments for 'config' command\r\n"
 
 
 class RedisCommandHandler:
-    def __init__(self, server: RedisServer, storage: Storage | None) -> None:
+    def __init__(self, server: RedisServer, storage: Storage) -> None:
         self._server = server
-        self._storage = storage or Storage()
-
-    async def handle(self, message: Message, connection: Connection) -> list[Any]:
-        if isinstance(message.parsed, str) and message.parsed.startswith("REDIS"):
-            self._server.handshake_finished = True
-
-        if not isinstance(message.parsed, list):
+        self._storage = storage
+        self._commands: dict[bytes, ICommand] = {
+            name.encode(): command_class(server, self._storage)
+            for name, command_class in _COMMANDS.items()
+        }
+
+    def handle(
+        self, message: Message, connection: Connection
+    ) -> list[Any] | Awaitable[list[Any]]:
+        if type(message.parsed) is not list:
+            if type(message.parsed) is RDBString and message.parsed.startswith(b"REDIS"):
+                self._server.handshake_finished = True
             return []
 
-        command_class: ICommand | None = {
-            "ping": PingCommand,
-            "echo": EchoCommand,
-            "set": SetCommand,
-            "get": GetCommand,
-            "xadd": XAddCommand,
-            "xrange": XRangeCommand,
-            "xread": XReadCommand,
-            "type": TypeCommand,
-            "info": InfoCommand,
-            "replconf": ReplconfCommand,
-            "psync": PsyncCommand,
-            "wait": WaitCommand,
-            "config": ConfigCommand,
-            "keys": KeysCommand,
-        }.get(message.parsed[0].lower())
-
-        if command_class is None:
-            return [ErrorString("Unknown command")]
-
-        response = [
-            item
-            async for item in command_class(self._server, self._storage, connection).execute(
-                message
-            )
-        ]
+        try:
+            command = self._commands[message.cmd]
+        except KeyError:
+            return [_ERR_UNKNOWN_COMMAND]
+
+        response = command.execute(message, connection)
 
         if self._server.handshake_finished:
             self._server.inc_offset(message.size)
@@ -67,134 +97,160 @@ class RedisCommandHandler:
 
 
 class ICommand(ABC):
-    lowercase_message = False
+    lowercase_subcommand = False
     respond_master = False
     propagate = False
 
-    def __init__(self, server: RedisServer, storage: Storage, connection: Connection) -> None:
+    def __init__(self, server: RedisServer, storage: Storage) -> None:
         self._server = server
         self._storage = storage
-        self._connection = connection
+        self._is_master_server = server.is_master
+        self._send_response = self._is_master_server or self.respond_master
+        self._propagate_to_replicas = self._is_master_server and self.propagate
+
+    def _prepare(self, message: Message) -> None:
+        if self.lowercase_subcommand and len(message.parsed) > 1:
+            message.parsed[1] = message.parsed[1].lower()
 
-    async def execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
-        if self.lowercase_message:
-            message.parsed = [item.lower() for item in message.parsed]
+    def _finish(self, message: Message, response: list[Any]) -> list[Any]:
+        if self._propagate_to_replicas:
+            self._server.propagate(message)
 
-        async for item in self._execute(message):
-            if self._server.is_master or self.respond_master:
-                yield item
+        return response if self._send_response else []
 
-        if self.propagate:
-            from app.server import MasterServer
 
-            if isinstance(self._server, MasterServer):
-                asyncio.create_task(self._server.propagate(message))
+class SyncCommand(ICommand):
+    def execute(self, message: Message, connection: Connection) -> list[Any]:
+        self._prepare(message)
+        return self._finish(message, self._execute(message, connection))
 
     @abstractmethod
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         raise NotImplementedError
 
 
-def bulk_string_wrap(xrange: list | None) -> list | None:
-    if not xrange:
-        return None
-    return [
-        BulkString(v) if isinstance(v, str) or isinstance(v, EntryId) else bulk_string_wrap(v)
-        for v in xrange
-    ]
+class AsyncCommand(ICommand):
+    async def execute(self, message: Message, connection: Connection) -> list[Any]:
+        self._prepare(message)
+        return self._finish(message, await self._execute(message, connection))
+
+    @abstractmethod
+    async def _execute(self, message: Message, connection: Connection) -> list[Any]:
+        raise NotImplementedError
 
 
-class PingCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
-        yield SimpleString("PONG")
+class PingCommand(SyncCommand):
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
+        return [_PONG]
 
 
-class EchoCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
-        yield BulkString(message.parsed[1])
+class EchoCommand(SyncCommand):
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
+        return [BulkString(message.parsed[1])]
 
 
-class SetCommand(ICommand):
+class SetCommand(SyncCommand):
     propagate = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+    def _execute(
+        self,
+        message: Message,
+        connection: Connection,
+        *,
+        _StorageValue: type[StorageValue] = StorageValue,
+        _monotonic_ns: Callable[[], int] = time.monotonic_ns,
+    ) -> list[Any]:
         match message.parsed[1:]:
             case [key, value]:
-                self._storage[key] = StorageValue(value)
-                yield SimpleString("OK")
+                self._storage[key] = _StorageValue(value)
+                return [_OK]
             case [key, value, "px", expired_time]:
-                expired_time = datetime.datetime.now() + datetime.timedelta(
-                    milliseconds=int(expired_time)
-                )
-                self._storage[key] = StorageValue(value, expired_time)
-                yield SimpleString("OK")
+                expired_time = _monotonic_ns() // 1_000_000 + int(expired_time)
+                self._storage[key] = _StorageValue(value, expired_time)
+                return [_OK]
+            case _:
+                return [_ERR_SET_ARGS]
 
 
-class GetCommand(ICommand):
+class GetCommand(SyncCommand):
     respond_master = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | None, None]:
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case [key]:
                 value = self._storage[key]
-                yield BulkString(value) if value else None
+                if value is None:
+                    return [_NULL]
+                return [value if type(value) is BulkString else BulkString(value)]
             case _:
-                yield ErrorString("Wrong number of arguments for 'get' command")
+                return [_ERR_GET_ARGS]
 
 
-class XAddCommand(ICommand):
+class XAddCommand(SyncCommand):
     propagate = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case [stream_key, entry_id, *entries]:
                 try:
-                    yield BulkString(self._xadd(stream_key, entry_id, entries))
+                    return [BulkString(self._xadd(stream_key, entry_id, entries))]
                 except RedisError as e:
-                    yield ErrorString(e.message)
+                    return [ErrorString(e.message)]
             case _:
-                yield ErrorString("Wrong number of arguments for 'xadd' command")
+                return [_ERR_XADD_ARGS]
 
-    def _xadd(self, stream_key: str, entry_id: str, entries: list[str]) -> EntryId:
-        if self._storage[stream_key] is None:
-            self._storage[stream_key] = StorageValue(Stream())
-        stream: Stream = self._storage[stream_key]
+    def _xadd(self, stream_key: str, entry_id: str, entries: list[BulkString]) -> EntryId:
+        stream: Stream | None = self._storage[stream_key]
+        if stream is None:
+            stream = Stream()
+            self._storage[stream_key] = StorageValue(stream)
 
         result = stream.xadd(entry_id, entries)
         self._server.check_stream_triggers(stream_key, result)
         return result
 
 
-class XRangeCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+class XRangeCommand(SyncCommand):
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case [stream_key, start, end]:
-                stream: Stream = self._storage[stream_key]
-                yield bulk_string_wrap(stream.xrange(start, end))
+                stream: Stream | None = self._storage[stream_key]
+                if stream is None:
+                    return [_NULL]
+                return [stream.xrange(start, end) or _NULL]
             case _:
-                yield ErrorString("Wrong number of arguments for 'xrange' command")
+                return [_ERR_XRANGE_ARGS]
 
 
-class XReadCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+class XReadCommand(AsyncCommand):
+    async def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case ["streams", *streams]:
-                yield bulk_string_wrap(await self._xread(streams))
+                return [await self._xread(streams)]
             case ["block", block_time, "streams", *streams]:
-                yield bulk_string_wrap(await self._xread(streams, float(block_time) / 1000.0))
+                return [await self._xread(streams, float(block_time) / 1000.0)]
             case _:
-                yield ErrorString("Wrong number of arguments for 'xread' command")
-
-    async def _xread(self, streams: list[str], block_time: float | None = None) -> list:
-        stream_entry_id = [
-            (stream_key, EntryId.from_string(start, self._storage[stream_key]))
-            for stream_key, start in to_pairs(streams)
+                return [_ERR_XREAD_ARGS]
+
+    async def _xread(
+        self,
+        streams: list[str],
+        block_time: float | None = None,
+        *,
+        _from_string: Callable[[str, Stream | None], EntryId] = EntryId.from_string,
+    ) -> list:
+        pairs = to_pairs(streams)
+        found: list[Stream | None] = self._storage.mget([stream_key for stream_key, _ in pairs])
+        resolved: list[tuple[str, Stream | None, EntryId]] = [
+            (stream_key, stream, _from_string(start, stream))
+            for (stream_key, start), stream in zip(pairs, found)
         ]
+
         if block_time is not None:
             trigger = StreamTrigger(
                 asyncio.Event(),
-                stream_entry_id[0][0],
-                stream_entry_id[0][1],
+                resolved[0][0],
+                resolved[0][2],
             )
             self._server.register_stream_trigger(trigger)
             if block_time > 0:
@@ -204,90 +260,89 @@ class XReadCommand(ICommand):
                 await trigger.event.wait()
 
         result = []
-        for stream_key, entry_id in stream_entry_id:
-            stream: Stream | None = self._storage[stream_key]
+        for stream_key, stream, entry_id in resolved:
+            if stream is None and block_time is not None:
+                stream = self._storage[stream_key]
             if stream is None:
                 continue
             stream_items = stream.xread(entry_id)
             if stream_items:
-                result.append([stream_key, stream_items])
+                result.append([BulkString(stream_key), stream_items])
         if not result:
-            return [None]
+            return [_NULL]
         return result
 
 
-class TypeCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+class TypeCommand(SyncCommand):
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         value = self._storage[message.parsed[1]]
-        if isinstance(value, str):
-            yield SimpleString("string")
-        elif isinstance(value, Stream):
-            yield SimpleString("stream")
-        yield SimpleString("none")
+        return [_TYPE_TABLE.get(type(value), _TYPE_NONE)]
 
 
-class InfoCommand(ICommand):
-    lowercase_message = True
+class InfoCommand(SyncCommand):
+    lowercase_subcommand = True
     respond_master = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+    _replication_prefix: bytes | None = None
+
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case ["replication"]:
-                role = "master" if self._server.is_master else "slave"
-                yield BulkString(
-                    f"# Replication\nrole:{role}\nmaster_replid:{self._server.master_id}\nmaster_repl_offset:{self._server.offset}"
-                )
+                body = self._get_replication_prefix() + str(self._server.offset).encode()
+                return [b"$%d\r\n%b\r\n" % (len(body), body)]
             case _:
-                yield ErrorString("Wrong arguments for 'info' command")
+                return [_ERR_INFO_ARGS]
 
+    def _get_replication_prefix(self) -> bytes:
+        # master_id is assigned after the handler is built, so the prefix is filled in lazily.
+        if self._replication_prefix is None:
+            role = "master" if self._is_master_server else "slave"
+            self._replication_prefix = (
+                f"# Replication\nrole:{role}\nmaster_replid:{self._server.master_id}\n"
+                "master_repl_offset:"
+            ).encode()
+        return self._replication_prefix
 
-class ReplconfCommand(ICommand):
-    lowercase_message = True
+
+class ReplconfCommand(SyncCommand):
+    lowercase_subcommand = True
     respond_master = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case ["getack", "*"]:
-                yield [
-                    BulkString("REPLCONF"),
-                    BulkString("ACK"),
-                    BulkString(str(self._server.offset)),
-                ]
+                return [[_REPLCONF_BS, _ACK_BS, BulkString(str(self._server.offset))]]
             case ["ack", offset]:
-                from app.server import MasterServer
-
-                if isinstance(self._server, MasterServer):
-                    self._server.store_offset(self._connection, int(offset))
-
+                if self._is_master_server:
+                    self._server.store_offset(connection, int(offset))
+                return []
             case ["listening-port", _]:
-                yield SimpleString("OK")
+                return [_OK]
             case ["capa", "psync2"]:
-                yield SimpleString("OK")
+                return [_OK]
             case _:
-                yield ErrorString("Wrong arguments for'replconf' command")
+                return [_ERR_REPLCONF_ARGS]
 
 
-class PsyncCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+class PsyncCommand(SyncCommand):
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case ["?", "-1"]:
-                from app.server import MasterServer
-
-                if isinstance(self._server, MasterServer):
-                    self._server.store_connection(self._connection)
+                if self._is_master_server:
+                    self._server.store_connection(connection)
 
-                yield SimpleString(f"FULLRESYNC {self._server.master_id} {self._server.offset}")
-                yield RDBString(default_rdb)
+                return [
+                    SimpleString(f"FULLRESYNC {self._server.master_id} {self._server.offset}"),
+                    _DEFAULT_RDB,
+                ]
             case _:
-                yield ErrorString("Wrong arguments for 'psync' command")
+                return [_ERR_PSYNC_ARGS]
 
 
-class WaitCommand(ICommand):
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
-        from app.server import MasterServer
-
-        if not isinstance(self._server, MasterServer):
-            yield ErrorString("Only available for master")
+class WaitCommand(AsyncCommand):
+    async def _execute(self, message: Message, connection: Connection) -> list[Any]:
+        if not self._is_master_server:
+            return [_ERR_NOT_MASTER]
 
         match message.parsed[1:]:
             case [num_replicas, timeout]:
@@ -296,45 +351,59 @@ class WaitCommand(ICommand):
                 master_offset = self._server.offset
                 synced_replicas = self._server.count_synced_replicas(master_offset)
                 if num_replicas <= synced_replicas:
-                    yield self._server.num_replicas
-                    return
+                    return [self._server.num_replicas]
 
                 trigger = WaitTrigger.create(num_replicas, master_offset)
-                self._server.register_stream_trigger(trigger)
+                self._server.register_wait_trigger(trigger)
 
-                await self._server.propagate(
-                    Message.from_parsed(
-                        [BulkString("REPLCONF"), BulkString("GETACK"), BulkString("*")]
-                    )
-                )
+                self._server.propagate_raw(_GETACK_WIRE)
 
                 with contextlib.suppress(asyncio.TimeoutError):
                     await asyncio.wait_for(trigger.event.wait(), timeout / 1000)
 
-                yield self._server.count_synced_replicas(master_offset)
+                return [self._server.count_synced_replicas(master_offset)]
 
             case _:
-                yield ErrorString("Wrong arguments for 'wait' command")
+                return [_ERR_WAIT_ARGS]
 
 
-class ConfigCommand(ICommand):
-    lowercase_message = True
+class ConfigCommand(SyncCommand):
+    lowercase_subcommand = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         match message.parsed[1:]:
             case ["get", key]:
+                key = key.lower()
                 if key not in {"dir", "dbfilename"}:
-                    yield ErrorString(f"Unknown config key {key}")
-                yield [BulkString(key), BulkString(self._server.config[key])]
+                    return [ErrorString(f"Unknown config key {key}")]
+                return [[BulkString(key), BulkString(self._server.config[key])]]
             case _:
-                yield ErrorString("Wrong arguments for 'config' command")
-
+                return [_ERR_CONFIG_ARGS]
 
-class KeysCommand(ICommand):
-    lowercase_message = True
 
-    async def _execute(self, message: Message) -> AsyncGenerator[list[str] | str | bytes, None]:
+class KeysCommand(SyncCommand):
+    def _execute(self, message: Message, connection: Connection) -> list[Any]:
         subcommand = message.parsed[1]
         if subcommand == "*":
-            yield [BulkString(key) for key in self._storage]
-        yield ErrorString("Unknown keys subcommand {subcommand}")
+            return [list(map(BulkString, self._storage.keys()))]
+        return [ErrorString(f"Unknown keys subcommand {subcommand}")]
+
+
+_COMMANDS: Mapping[str, type[ICommand]] = MappingProxyType(
+    {
+        "ping": PingCommand,
+        "echo": EchoCommand,
+        "set": SetCommand,
+        "get": GetCommand,
+        "xadd": XAddCommand,
+        "xrange": XRangeCommand,
+        "xread": XReadCommand,
+        "type": TypeCommand,
+        "info": InfoCommand,
+        "replconf": ReplconfCommand,
+        "psync": PsyncCommand,
+        "wait": WaitCommand,
+        "config": ConfigCommand,
+        "keys": KeysCommand,
+    }
+)
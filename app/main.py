@@ -1,10 +1,17 @@
 import argparse
 import asyncio
+import logging
 
 from app.server import MasterServer, SlaveServer
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 async def main():
+    logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=6379)
     parser.add_argument("--replicaof", type=str, nargs="+", default=None)
@@ -26,4 +33,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
@@ -1,9 +1,12 @@
-import datetime
-import io
+import mmap
+import os
+import struct
+import time
 from enum import Enum
 from pathlib import Path
-from typing import Literal
+from typing import Any, Callable
 
+from app.redis_serde import BulkString
 from app.schemas import StorageValue
 from app.storage import Storage
 
@@ -14,99 +17,172 @@ class SpecialEncoding(Enum):
     INT_32 = 2
 
 
+_MMAP_THRESHOLD = 64 * 1024
+
+_U8 = struct.Struct("<B")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_unpack_u32 = _U32.unpack_from
+_unpack_u64 = _U64.unpack_from
+_U32_BE = struct.Struct(">I")
+_U64_BE = struct.Struct(">Q")
+# Indexed by SpecialEncoding value.
+_SPECIAL_INT_FORMATS = (struct.Struct("<b"), struct.Struct("<h"), struct.Struct("<i"))
+
+
+def _length_entry(byte: int) -> tuple[int, int | SpecialEncoding | None]:
+    kind, payload = byte >> 6, byte & 0b00111111
+    if kind == 3:
+        return kind, SpecialEncoding(payload) if payload <= SpecialEncoding.INT_32.value else None
+    return kind, payload
+
+
+# Decoded (kind, payload) pair for every possible first byte of a length.
+_LENGTH_TABLE = tuple(_length_entry(byte) for byte in range(256))
+
+
 class PersistantStorage:
     def __init__(self, file: Path) -> None:
         self._file = file
         self._storage = Storage()
+        self._data = memoryview(b"")
+        self._pos = 0
+        self._now = 0
+        self._monotonic_offset = 0
+        self._op_codes: dict[int, Callable[[], Any]] = {
+            0xFA: self._read_auxiliary,
+            0xFB: self._read_resize_db,
+            0xFC: self._read_pair_with_expiry_ms,
+            0xFD: self._read_pair_with_expiry_s,
+            0xFE: self._read_db_selector,
+            0x00: self._read_pair,
+        }
 
     def create_storage(self):
         if not self._file.exists():
             return self._storage
         with self._file.open("rb") as f:
-            self._read_magic_string(f)
-            self._read_version(f)
-            while True:
-                try:
-                    self._read_next(f)
-                except StopIteration:
-                    break
+            size = os.fstat(f.fileno()).st_size
+            if size < _MMAP_THRESHOLD:
+                self._data = memoryview(f.read())
+                self._parse()
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    self._data = memoryview(mapped)
+                    try:
+                        self._parse()
+                    finally:
+                        # The map can only be closed once no view into it is left.
+                        self._data.release()
+                        self._data = memoryview(b"")
         return self._storage
 
-    def _read_magic_string(self, f: io.BufferedReader):
-        assert f.read(5) == b"REDIS"
-
-    def _read_version(self, f: io.BufferedReader):
-        f.read(4)
-
-    def _read_next(self, f: io.BufferedReader):
-        op_code = f.read(1)
-        match int.from_bytes(op_code):
-            case 0xFA:
-                self._read_auxiliary(f)
-            case 0xFB:
-                self._read_resize_db(f)
-            case 0xFC:
-                self._read_pair_with_expiry(f, "ms")
-            case 0xFD:
-                self._read_pair_with_expiry(f, "s")
-            case 0xFE:
-                self._read_db_selector(f)
-            case 0xFF:
-                self._read_checksum(f)
-                raise StopIteration
-            case 0x00:
-                self._read_pair(f)
-
-    def _read_auxiliary(self, f: io.BufferedReader):
-        key = self._read_value(f)
-        value = self._read_value(f)
+    def _parse(self):
+        self._pos = 0
+        self._now = time.time_ns() // 1_000_000
+        self._monotonic_offset = time.monotonic_ns() // 1_000_000 - self._now
+        self._read_magic_string()
+        self._read_version()
+        data = self._data
+        op_codes = self._op_codes
+        while self._pos < len(data):
+            op_code = data[self._pos]
+            self._pos += 1
+            if op_code == 0xFF:
+                self._read_checksum()
+                break
+            read = op_codes.get(op_code)
+            if read is None:
+                raise ValueError(f"Unsupported RDB op code {op_code:#x}")
+            read()
+
+    def _read(self, size: int) -> memoryview:
+        pos = self._pos
+        self._pos = pos + size
+        return self._data[pos : pos + size]
+
+    def _unpack(self, fmt: struct.Struct) -> int:
+        value = fmt.unpack_from(self._data, self._pos)[0]
+        self._pos += fmt.size
+        return value
+
+    def _read_magic_string(self):
+        assert self._read(5) == b"REDIS"
+
+    def _read_version(self):
+        self._pos += 4
+
+    def _read_auxiliary(self):
+        key = self._read_value()
+        value = self._read_value()
         return key, value
 
-    def _read_resize_db(self, f: io.BufferedReader):
-        table_size = self._read_length(f)
-        expire_hash_table = self._read_length(f)
+    def _read_resize_db(self):
+        table_size = self._read_length()
+        expire_hash_table = self._read_length()
         return table_size, expire_hash_table
 
-    def _read_db_selector(self, f: io.BufferedReader):
-        db_number = int.from_bytes(f.read(1), "little")
+    def _read_db_selector(self):
+        db_number = self._unpack(_U8)
         return db_number
 
-    def _read_pair_with_expiry(self, f: io.BufferedReader, units: Literal["s", "ms"]):
-        expiry_time = int.from_bytes(f.read(8 if units == "ms" else 4), "little")
-        if units == "ms":
-            expiry_time /= 1000.0
-        f.read(1)
-        self._read_pair(f, datetime.datetime.fromtimestamp(expiry_time))
-
-    def _read_pair(self, f: io.BufferedReader, expired_time: datetime.datetime | None = None):
-        key = str(self._read_value(f))
-        value = self._read_value(f)
-        if expired_time and expired_time < datetime.datetime.now():
+    def _read_pair_with_expiry_ms(self):
+        (expiry_time,) = _unpack_u64(self._data, self._pos)
+        # Skip the value type byte that follows the timestamp.
+        self._pos += _U64.size + 1
+        self._read_pair(expiry_time)
+
+    def _read_pair_with_expiry_s(self):
+        (expiry_time,) = _unpack_u32(self._data, self._pos)
+        self._pos += _U32.size + 1
+        self._read_pair(expiry_time * 1000)
+
+    def _read_pair(self, expired_time: int | None = None):
+        key = self._read_value()
+        if type(key) is int:
+            key = str(key)
+        value = self._read_value()
+        if expired_time is None:
+            self._storage[key] = StorageValue(value)
+            return
+        if expired_time < self._now:
             return
-        self._storage[key] = StorageValue(value)
+        self._storage[key] = StorageValue(value, expired_time + self._monotonic_offset)
 
-    def _read_checksum(self, f: io.BufferedReader):
-        checksum = int.from_bytes(f.read(8), "little")
+    def _read_checksum(self):
+        checksum = self._unpack(_U64)
         return checksum
 
-    def _read_value(self, f: io.BufferedReader) -> str | int:
-        length = self._read_length(f)
+    def _read_value(self) -> str | int:
+        length = self._read_length()
         if isinstance(length, SpecialEncoding):
-            return self._read_special_encoded_int(f, length)
+            return self._read_special_encoded_int(length)
 
-        return f.read(length).decode("utf-8")
+        # Decoded straight into the type GET replies with, so it is returned without a copy.
+        return BulkString(self._read(length), "utf-8")
 
-    def _read_special_encoded_int(self, f: io.BufferedReader, le_format: SpecialEncoding) -> int:
-        return int.from_bytes(f.read(le_format.value + 1))
+    def _read_special_encoded_int(self, le_format: SpecialEncoding) -> int:
+        return self._unpack(_SPECIAL_INT_FORMATS[le_format.value])
 
-    def _read_length(self, f: io.BufferedReader) -> int | SpecialEncoding:
-        length = int.from_bytes(f.read(1))
-        match length >> 6:
+    def _read_length(self) -> int | SpecialEncoding:
+        data = self._data
+        pos = self._pos
+        kind, payload = _LENGTH_TABLE[data[pos]]
+        self._pos = pos + 1
+        match kind:
             case 0:
-                return length
+                return payload
             case 1:
-                return (length << 8) + int.from_bytes(f.read(1))
-            case 3:
-                return SpecialEncoding(length & 0b00111111)
-            case _:
+                self._pos = pos + 2
+                return (payload << 8) | data[pos + 1]
+            case 2:
+                # 0x80 is followed by a 32-bit length, 0x81 by a 64-bit one.
+                if payload == 0:
+                    return self._unpack(_U32_BE)
+                if payload == 1:
+                    return self._unpack(_U64_BE)
                 raise ValueError("Invalid length")
+            case _:
+                if payload is None:
+                    raise ValueError("Invalid length")
+                return payload
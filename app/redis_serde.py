@@ -1,5 +1,13 @@
-from dataclasses import dataclass
-from typing import Any, Generator
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+_BULK_PREFIXES_COUNT = 1024
+_ARRAY_PREFIXES_COUNT = 256
+_BULK_PREFIXES = tuple(b"$%d\r\n" % size for size in range(_BULK_PREFIXES_COUNT))
+_ARRAY_PREFIXES = tuple(b"*%d\r\n" % size for size in range(_ARRAY_PREFIXES_COUNT))
 
 
 class SimpleString(str): ...
@@ -14,80 +22,230 @@ class RDBString(bytes): ...
 class ErrorString(str): ...
 
 
+class IncompleteMessage(Exception):
+    def __init__(self, needed: int = 0) -> None:
+        super().__init__(needed)
+        # Absolute end index the frame is known to need, or 0 when it is not known yet.
+        self.needed = needed
+
+
 class RedisSerializer:
     def serialize(self, message: Any) -> bytes:
-        return self._serialize_impl(message)
-
-    def _serialize_impl(self, message: Any) -> bytes:
-        if isinstance(message, BulkString):
-            return f"${len(message)}\r\n{message}\r\n".encode()
-        elif isinstance(message, SimpleString):
-            return f"+{message}\r\n".encode()
-        elif isinstance(message, ErrorString):
-            return f"-ERR {message}\r\n".encode()
-        elif isinstance(message, RDBString):
-            return f"${len(message)}\r\n".encode() + message
-        elif message is None:
-            return "$-1\r\n".encode()
-        elif isinstance(message, list):
-            return f"*{len(message)}\r\n".encode() + b"".join(
-                self._serialize_impl(item) for item in message
-            )
-        elif isinstance(message, int):
-            return f":{message}\r\n".encode()
-        else:
-            raise ValueError(f"Unsupported message type {type(message)}")
-
-    def deserialize(self, message: bytes) -> Generator["Message", None, None]:
-        start_index = 0
-        while True:
-            value, end_index = self._deserialize_impl(message, start_index)
-            yield Message(value, message[start_index:end_index], end_index - start_index)
-            start_index = end_index
-            if start_index >= len(message):
-                break
+        if type(message) is bytes:
+            return message
+        out = bytearray()
+        self._serialize_impl(message, out)
+        return bytes(out)
+
+    def serialize_many(self, messages: Iterable[Any], out: bytearray | None = None) -> bytearray:
+        if out is None:
+            out = bytearray()
+        for message in messages:
+            self._serialize_impl(message, out)
+        return out
+
+    def _serialize_impl(self, message: Any, out: bytearray) -> None:
+        serializer = self._SERIALIZERS.get(type(message))
+        if serializer is None:
+            serializer = self._find_serializer(type(message))
+        serializer(self, message, out)
+
+    def _find_serializer(self, message_type: type) -> Callable[..., None]:
+        for base in message_type.__mro__[1:]:
+            if base in self._SERIALIZERS:
+                return self._SERIALIZERS[base]
+        raise ValueError(f"Unsupported message type {message_type}")
+
+    def _serialize_raw(self, message: bytes, out: bytearray) -> None:
+        out += message
+
+    def _serialize_bulk_string(self, message: BulkString, out: bytearray) -> None:
+        data = message.encode()
+        size = len(data)
+        out += _BULK_PREFIXES[size] if size < _BULK_PREFIXES_COUNT else b"$%d\r\n" % size
+        out += data
+        out += b"\r\n"
+
+    def _serialize_simple_string(self, message: SimpleString, out: bytearray) -> None:
+        out += b"+%b\r\n" % message.encode()
+
+    def _serialize_error(self, message: ErrorString, out: bytearray) -> None:
+        out += b"-ERR %b\r\n" % message.encode()
+
+    def _serialize_rdb(self, message: RDBString, out: bytearray) -> None:
+        out += b"$%d\r\n" % len(message)
+        out += message
+
+    def _serialize_none(self, message: None, out: bytearray) -> None:
+        out += b"$-1\r\n"
+
+    def _serialize_array(self, message: list, out: bytearray) -> None:
+        size = len(message)
+        out += _ARRAY_PREFIXES[size] if size < _ARRAY_PREFIXES_COUNT else b"*%d\r\n" % size
+        for item in message:
+            self._serialize_impl(item, out)
+
+    def _serialize_integer(self, message: int, out: bytearray) -> None:
+        out += b":%d\r\n" % message
+
+    _SERIALIZERS = {
+        bytes: _serialize_raw,
+        BulkString: _serialize_bulk_string,
+        SimpleString: _serialize_simple_string,
+        ErrorString: _serialize_error,
+        RDBString: _serialize_rdb,
+        type(None): _serialize_none,
+        list: _serialize_array,
+        int: _serialize_integer,
+    }
+
+    def deserialize_frame(self, message: bytes, start_index: int = 0) -> "Message":
+        parser = self._TOP_LEVEL_PARSERS.get(message[start_index])
+        if parser is None:
+            logger.warning("Unknown message %r", message)
+            return Message(None, message[start_index:], len(message) - start_index)
+        value, end_index = parser(self, message, start_index)
+        return Message(value, message[start_index:end_index], end_index - start_index)
 
     def _deserialize_impl(self, message: bytes, start_index: int = 0) -> Any:
-        if len(message) - start_index == 0:
-            return None, None
-        if message[start_index] == ord("*"):
-            num_elements, end_index = self._parse_number(message, start_index + 1)
-            arr = []
-            while len(arr) < num_elements:
-                elem, end_index = self._deserialize_impl(message, end_index + 2)
+        if start_index >= len(message):
+            raise IncompleteMessage
+        parser = self._PARSERS.get(message[start_index])
+        if parser is None:
+            raise ValueError(f"Unknown message type {message[start_index:start_index + 1]!r}")
+        return parser(self, message, start_index)
+
+    def _deserialize_command(self, message: bytes, start_index: int) -> Any:
+        return self._deserialize_array(message, start_index, command=True)
+
+    def _deserialize_array(self, message: bytes, start_index: int, command: bool = False) -> Any:
+        num_elements, end_index = self._parse_number(message, start_index + 1)
+        arr = []
+        size = len(message)
+        # Commands are arrays of bulk strings, so those are parsed inline.
+        while len(arr) < num_elements:
+            if end_index < size and message[end_index] == 36:  # b"$"
+                header_end = message.find(b"\r\n", end_index)
+                if header_end == -1:
+                    raise IncompleteMessage
+                data_start = header_end + 2
+                length = int(message[end_index + 1 : header_end])
+                if length < 0:
+                    arr.append(None)
+                    end_index = data_start
+                    continue
+                data_end = data_start + length
+                if data_end + 2 > size:
+                    raise IncompleteMessage(data_end + 2)
+                if command and not arr:
+                    # The command name stays as lower-cased bytes and is dispatched on as is.
+                    arr.append(bytes(message[data_start:data_end]).lower())
+                else:
+                    arr.append(BulkString(message[data_start:data_end].decode(errors="ignore")))
+                end_index = data_end + 2
+            else:
+                elem, end_index = self._deserialize_impl(message, end_index)
                 arr.append(elem)
-            return arr, end_index + 2
-        elif message[start_index] == ord("$"):
-            size, end_index = self._parse_number(message, start_index + 1)
-            return BulkString(
-                message[end_index + 2 : end_index + 2 + size].decode(errors="ignore")
-            ), end_index + 2 + size
-        elif message[start_index] == ord("+"):
-            end_index = message.index(b"\r\n")
-            return SimpleString(
-                message[start_index + 1 : end_index].decode(errors="ignore")
-            ), end_index + 2
-        print(f"Unknown message {message}")
-        return None, None
+        return arr, end_index
+
+    def _deserialize_bulk_string(self, message: bytes, start_index: int) -> Any:
+        size, data_start = self._parse_number(message, start_index + 1)
+        if size < 0:
+            return None, data_start
+        data_end = data_start + size
+        if data_end + 2 > len(message):
+            raise IncompleteMessage(data_end + 2)
+        return BulkString(message[data_start:data_end].decode(errors="ignore")), data_end + 2
+
+    def _deserialize_rdb(self, message: bytes, start_index: int) -> Any:
+        size, data_start = self._parse_number(message, start_index + 1)
+        if size < 0:
+            return None, data_start
+        data_end = data_start + size
+        if data_end > len(message):
+            raise IncompleteMessage(data_end)
+        # The payload is binary: keep it as bytes, copied once out of a memoryview.
+        return RDBString(memoryview(message)[data_start:data_end]), data_end
+
+    def _deserialize_simple_string(self, message: bytes, start_index: int) -> Any:
+        end_index = message.find(b"\r\n", start_index)
+        if end_index == -1:
+            raise IncompleteMessage
+        return SimpleString(
+            message[start_index + 1 : end_index].decode(errors="ignore")
+        ), end_index + 2
+
+    def _deserialize_integer(self, message: bytes, start_index: int) -> Any:
+        end_index = message.find(b"\r\n", start_index)
+        if end_index == -1:
+            raise IncompleteMessage
+        return int(message[start_index + 1 : end_index]), end_index + 2
 
     def _parse_number(self, message: bytes, start_index: int) -> tuple[int, int]:
-        end_index = start_index
-        while ord("0") <= message[end_index] <= ord("9"):
-            end_index += 1
-        return int(message[start_index:end_index]), end_index
-
-
-@dataclass
+        end_index = message.find(b"\r\n", start_index)
+        if end_index == -1:
+            raise IncompleteMessage
+        return int(message[start_index:end_index]), end_index + 2
+
+    _PARSERS = {
+        ord("*"): _deserialize_array,
+        ord("$"): _deserialize_bulk_string,
+        ord("+"): _deserialize_simple_string,
+        ord(":"): _deserialize_integer,
+    }
+    # A bulk string at the top level only arrives as the RDB payload after
+    # FULLRESYNC, which is not terminated by CRLF.
+    _TOP_LEVEL_PARSERS = {**_PARSERS, ord("*"): _deserialize_command, ord("$"): _deserialize_rdb}
+
+
+_SERIALIZER = RedisSerializer()
+_COMPACT_THRESHOLD = 32 * 1024
+
+
+class MessageReader:
+    def __init__(self) -> None:
+        self._buffer: bytes | bytearray = b""
+        self._pos = 0
+        # Buffered bytes (from _pos) the pending frame needs before it is worth parsing again.
+        self._needed = 0
+
+    def feed(self, data: bytes | memoryview) -> None:
+        if self._pos == len(self._buffer):
+            # Nothing is pending, so the chunk becomes the buffer (bytes() does not copy bytes).
+            self._buffer = bytes(data)
+            self._pos = 0
+            return
+        if type(self._buffer) is not bytearray or self._pos > _COMPACT_THRESHOLD:
+            self._buffer = bytearray(memoryview(self._buffer)[self._pos :])
+            self._pos = 0
+        self._buffer += data
+
+    def gets(self) -> "Message | None":
+        available = len(self._buffer) - self._pos
+        if available == 0 or available < self._needed:
+            return None
+        try:
+            message = _SERIALIZER.deserialize_frame(self._buffer, self._pos)
+        except IncompleteMessage as e:
+            self._needed = e.needed - self._pos
+            return None
+        self._needed = 0
+        self._pos += message.size
+        return message
+
+
+@dataclass(slots=True)
 class Message:
     parsed: Any
     raw: bytes
     size: int
-
-    @staticmethod
-    def from_parsed(parsed: Any) -> "Message":
-        raw = RedisSerializer().serialize(parsed)
-        return Message(parsed, raw, len(raw))
-
-    @staticmethod
-    def from_raw(raw: bytes) -> list["Message"]:
-        return list(RedisSerializer().deserialize(raw))
+    cmd: bytes = field(init=False, default=b"")
+
+    def __post_init__(self) -> None:
+        parsed = self.parsed
+        if type(parsed) is list and parsed:
+            cmd = parsed[0]
+            if type(cmd) is bytes:
+                self.cmd = cmd
+            elif isinstance(cmd, str):
+                self.cmd = cmd.encode().lower()
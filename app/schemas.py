@@ -1,29 +1,30 @@
 from __future__ import annotations
 
 import asyncio
-import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING, Any
 
+from app.redis_serde import MessageReader
+
 if TYPE_CHECKING:
     from app.storage import Stream
 
 PEERNAME = tuple[str, int, int, int]
 
 
-@dataclass
+@dataclass(slots=True)
 class Connection:
     peername: PEERNAME
-    reader: asyncio.StreamReader
-    writer: asyncio.StreamWriter
+    transport: asyncio.WriteTransport
     offset: int = 0
+    reader: MessageReader = field(default_factory=MessageReader)
 
     @staticmethod
-    def create(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> "Connection":
-        return Connection(writer.get_extra_info("peername"), reader, writer)
+    def create(transport: asyncio.WriteTransport) -> "Connection":
+        return Connection(transport.get_extra_info("peername"), transport)
 
 
-@dataclass
+@dataclass(slots=True)
 class WaitTrigger:
     event: asyncio.Event
     num_replicas: int
@@ -34,7 +35,7 @@ class WaitTrigger:
         return WaitTrigger(asyncio.Event(), num_replicas, master_offset)
 
 
-@dataclass(order=True, frozen=True)
+@dataclass(order=True, frozen=True, slots=True)
 class EntryId:
     timestamp: int | float
     sequence_number: int | float
@@ -47,21 +48,23 @@ class EntryId:
             else:
                 return stream.max_key()
 
-        timestamp, sequence_number = start.split("-")
+        timestamp, separator, sequence_number = start.partition("-")
+        if not separator:
+            raise ValueError(f"Invalid entry id {start}")
         return EntryId(int(timestamp), int(sequence_number))
 
     def __str__(self) -> str:
         return f"{self.timestamp}-{self.sequence_number}"
 
 
-@dataclass
+@dataclass(slots=True)
 class StreamTrigger:
     event: asyncio.Event
     key: str
     entry_id: EntryId | None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class StorageValue:
     value: Any
-    expired_time: datetime.datetime | None = None
+    expired_time: int | None = None
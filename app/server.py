@@ -1,78 +1,104 @@
 import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import socket
+import time
 from pathlib import Path
-from typing import Any
+from typing import Any, Awaitable
 
 from app.command_handler import RedisCommandHandler
 from app.persistence import PersistantStorage
 from app.redis_serde import BulkString, Message, RedisSerializer
 from app.schemas import PEERNAME, Connection, EntryId, StreamTrigger, WaitTrigger
+from app.storage import Storage
 from app.utils import random_id
 
-CHUNK_SIZE = 500
+CHUNK_SIZE = 64 * 1024
+EXPIRE_INTERVAL = 0.1
+SEND_BUFFER_SIZE = 1 << 20
+# A replication link with no traffic is probed after KEEPALIVE_IDLE seconds and dropped after
+# KEEPALIVE_COUNT unanswered probes, KEEPALIVE_INTERVAL seconds apart.
+KEEPALIVE_IDLE = 5
+KEEPALIVE_INTERVAL = 1
+KEEPALIVE_COUNT = 3
+
+logger = logging.getLogger(__name__)
+
+_SERIALIZER = RedisSerializer()
+_ANY_ENTRY = EntryId(-1, -1)
+
+
+def _enable_keepalive(transport: asyncio.BaseTransport) -> None:
+    sock = transport.get_extra_info("socket")
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The tuning options are platform specific (Linux); elsewhere the system defaults apply.
+    for option, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
 
 
 class RedisServer:
     def __init__(self, port: int, config: dict[str, str] | None = None) -> None:
         self._port = port
-        storage = None
         if config and "dir" in config and "dbfilename" in config:
-            storage = PersistantStorage(
+            self.storage = PersistantStorage(
                 Path(config["dir"]) / config["dbfilename"]
             ).create_storage()
-        self._handler = RedisCommandHandler(self, storage)
+        else:
+            self.storage = Storage()
+        self._handler = RedisCommandHandler(self, self.storage)
         self._offset = 0
         self.config = config or {}
         self.handshake_finished = False
-        self._stream_triggers: list[StreamTrigger] = []
+        # Per stream key, a heap of (entry_id, seq, trigger) so XADD only wakes what it passed.
+        self._stream_triggers: dict[str, list[tuple[EntryId, int, StreamTrigger]]] = {}
+        self._trigger_seq = itertools.count()
         self.master_id: str | None = None
 
     async def serve_forever(self) -> None:
-        server = await asyncio.start_server(self.handle_client, "localhost", self._port)
-        async with server:
-            await server.serve_forever()
-
-    async def handle_client(
-        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
-    ) -> None:
-        connection = Connection.create(reader, writer)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: RedisProtocol(self), "localhost", self._port)
+        expire_task = asyncio.create_task(self._expire_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expire_task.cancel()
+
+    async def _expire_loop(self) -> None:
         while True:
-            message = await reader.read(CHUNK_SIZE)
-            if not message:
-                break
-            print(f"{connection.peername}: {message!r}")
-            await self._receive_message(connection, message)
+            await asyncio.sleep(EXPIRE_INTERVAL)
+            self.storage.remove_expired(time.monotonic_ns() // 1_000_000)
+
+    def handle(self, message: Message, connection: Connection) -> list[Any] | Awaitable[list[Any]]:
+        return self._handler.handle(message, connection)
 
-        writer.close()
-        await writer.wait_closed()
+    def forget_connection(self, connection: Connection) -> None:
+        pass
 
     def register_stream_trigger(self, trigger: StreamTrigger) -> None:
-        self._stream_triggers.append(trigger)
+        entry_id = _ANY_ENTRY if trigger.entry_id is None else trigger.entry_id
+        heapq.heappush(
+            self._stream_triggers.setdefault(trigger.key, []),
+            (entry_id, next(self._trigger_seq), trigger),
+        )
 
     def check_stream_triggers(self, key: str, entry_id: EntryId) -> None:
-        for trigger in self._stream_triggers:
-            if (
-                trigger.entry_id is None
-                or trigger.key == key
-                and entry_id.timestamp > trigger.entry_id.timestamp
-                or (
-                    entry_id.timestamp == trigger.entry_id.timestamp
-                    and entry_id.sequence_number > trigger.entry_id.sequence_number
-                )
-            ):
-                trigger.event.set()
-                self._stream_triggers.remove(trigger)
-
-    async def _receive_message(self, connection: Connection, message: bytes) -> None:
-        for parsed_message in Message.from_raw(message):
-            print(f"parsed message: {parsed_message}")
-
-            raw_responses = await self._handler.handle(parsed_message, connection)
-
-            print("send messages", raw_responses)
-            for raw_out_message in raw_responses:
-                out_message = RedisSerializer().serialize(raw_out_message)
-                connection.writer.write(out_message)
-                await connection.writer.drain()
+        triggers = self._stream_triggers.get(key)
+        if not triggers:
+            return
+        while triggers and triggers[0][0] < entry_id:
+            heapq.heappop(triggers)[2].event.set()
+        if not triggers:
+            del self._stream_triggers[key]
 
     def inc_offset(self, offset: int) -> None:
         self._offset += offset
@@ -96,6 +122,7 @@ class MasterServer(RedisServer):
         self._port = port
         self._slave_connections: dict[PEERNAME, Connection] = {}
         self._wait_triggers: list[WaitTrigger] = []
+        self._propagate_buffer: list[bytes] = []
         self.master_id = random_id(40)
 
     @property
@@ -106,21 +133,29 @@ class MasterServer(RedisServer):
     def num_replicas(self) -> int:
         return len(self._slave_connections)
 
-    async def propagate(self, message: Message) -> None:
-        self.inc_offset(message.size)
-        to_remove = []
-        for peername, connection in self._slave_connections.items():
-            try:
-                connection.writer.write(message.raw)
-                await connection.writer.drain()
-            except ConnectionResetError:
-                to_remove.append(peername)
-        for peername in to_remove:
-            del self._slave_connections[peername]
+    def propagate(self, message: Message) -> None:
+        self.propagate_raw(message.raw)
+
+    def propagate_raw(self, raw: bytes) -> None:
+        self.inc_offset(len(raw))
+        if not self._slave_connections:
+            return
+        # Commands propagated while a batch is processed are sent to replicas in one write.
+        if not self._propagate_buffer:
+            asyncio.get_running_loop().call_soon(self._flush_propagated)
+        self._propagate_buffer.append(raw)
+
+    def _flush_propagated(self) -> None:
+        if not self._propagate_buffer:
+            return
+        buffer, self._propagate_buffer = self._propagate_buffer, []
+        for connection in self._slave_connections.values():
+            if not connection.transport.is_closing():
+                connection.transport.writelines(buffer)
 
     def store_offset(self, connection: Connection, offset: int) -> None:
         if connection.peername not in self._slave_connections:
-            print(f"Connection {connection.peername} not found")
+            logger.warning("Connection %s not found", connection.peername)
             return
 
         self._slave_connections[connection.peername].offset = offset
@@ -128,9 +163,6 @@ class MasterServer(RedisServer):
 
     def count_synced_replicas(self, offset: int) -> int:
         count = 0
-        print(
-            f"Master offset {offset}, slave offsets {[c.offset for c in self._slave_connections.values()]}"
-        )
         for connection in self._slave_connections.values():
             if connection.offset >= offset:
                 count += 1
@@ -140,22 +172,43 @@ class MasterServer(RedisServer):
         self._wait_triggers.append(trigger)
 
     def store_connection(self, connection: Connection) -> None:
+        self._flush_propagated()
+        _enable_keepalive(connection.transport)
         self._slave_connections[connection.peername] = connection
 
+    def forget_connection(self, connection: Connection) -> None:
+        self._slave_connections.pop(connection.peername, None)
+
     def _check_wait_triggers(self) -> None:
+        if not self._wait_triggers:
+            return
+        # Replica offsets are sorted once, so each trigger is checked with a bisect.
+        offsets = sorted(c.offset for c in self._slave_connections.values())
+        pending = []
         for trigger in self._wait_triggers:
-            if self.count_synced_replicas(trigger.master_offset) >= trigger.num_replicas:
+            synced = len(offsets) - bisect.bisect_left(offsets, trigger.master_offset)
+            if synced >= trigger.num_replicas:
                 trigger.event.set()
-                self._wait_triggers.remove(trigger)
+            elif not trigger.event.is_set():
+                pending.append(trigger)
+        self._wait_triggers = pending
 
 
 class SlaveServer(RedisServer):
+    # The handshake frames never change, so they are serialized once.
+    _PING_FRAME = _SERIALIZER.serialize([BulkString("ping")])
+    _CAPA_FRAME = _SERIALIZER.serialize(
+        [BulkString("REPLCONF"), BulkString("capa"), BulkString("psync2")]
+    )
+    _PSYNC_FRAME = _SERIALIZER.serialize([BulkString("PSYNC"), BulkString("?"), BulkString("-1")])
+
     def __init__(
         self, port: int, master_host: str, master_port: int, config: dict[str, str] | None = None
     ) -> None:
         super().__init__(port, config)
         self._master_host = master_host
         self._master_port = master_port
+        self._master_writer: asyncio.StreamWriter | None = None
 
     async def serve_forever(self) -> None:
         await self.connect_master()
@@ -163,26 +216,113 @@ class SlaveServer(RedisServer):
 
     async def connect_master(self) -> None:
         reader, writer = await asyncio.open_connection(self._master_host, self._master_port)
-        connection = Connection.create(reader, writer)
-        await self._send_request(connection, [BulkString("ping")])
-        await self._send_request(
-            connection,
-            [BulkString("REPLCONF"), BulkString("listening-port"), BulkString(self._port)],
-        )
-        await self._send_request(
-            connection,
-            [BulkString("REPLCONF"), BulkString("capa"), BulkString("psync2")],
-        )
-        await self._send_request(
-            connection,
-            [BulkString("PSYNC"), BulkString("?"), BulkString("-1")],
-        )
-        asyncio.create_task(self.handle_client(reader, writer))
-
-    async def _send_request(self, connection: Connection, message: Any) -> Any:
-        out_message = RedisSerializer().serialize(message)
-        connection.writer.write(out_message)
-        await connection.writer.drain()
-        raw_response = await connection.reader.read(CHUNK_SIZE)
-        print(f"Master raw response: {raw_response}")
-        await self._receive_message(connection, raw_response)
+        # The handshake waits on replies through the stream reader; afterwards the transport is
+        # handed over to the regular protocol. The writer is kept so it does not close the socket.
+        protocol = RedisProtocol(self)
+        protocol.connection_made(writer.transport)
+        try:
+            await self._send_request(reader, protocol, self._PING_FRAME)
+            await self._send_request(
+                reader,
+                protocol,
+                _SERIALIZER.serialize(
+                    [BulkString("REPLCONF"), BulkString("listening-port"), BulkString(self._port)]
+                ),
+            )
+            await self._send_request(reader, protocol, self._CAPA_FRAME)
+            await self._send_request(reader, protocol, self._PSYNC_FRAME)
+        except BaseException:
+            writer.close()
+            raise
+        _enable_keepalive(writer.transport)
+        writer.transport.set_protocol(protocol)
+        self._master_writer = writer
+
+    async def _send_request(
+        self, reader: asyncio.StreamReader, protocol: "RedisProtocol", frame: bytes
+    ) -> None:
+        protocol.transport.write(frame)
+        raw_response = await reader.read(CHUNK_SIZE)
+        if not raw_response:
+            raise ConnectionResetError("Master closed the connection during the handshake")
+        logger.debug("Master raw response: %r", raw_response)
+        protocol.feed(raw_response)
+
+
+class RedisProtocol(asyncio.BufferedProtocol):
+    def __init__(self, server: RedisServer) -> None:
+        self._server = server
+        # Reads land in this fixed buffer; only the received bytes are handed to the parser.
+        self._read_view = memoryview(bytearray(CHUNK_SIZE))
+        self._connection: Connection
+        self._pending: asyncio.Task | None = None
+
+    @property
+    def transport(self) -> asyncio.WriteTransport:
+        return self._connection.transport
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        self._connection = Connection.create(transport)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+        self._server.forget_connection(self._connection)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._read_view
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.feed(self._read_view[:nbytes])
+
+    def feed(self, data: bytes | memoryview) -> None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %r", self._connection.peername, data)
+        self._connection.reader.feed(data)
+        if self._pending is None:
+            self._process()
+
+    def _process(self) -> None:
+        connection = self._connection
+        reader = connection.reader
+        handle = self._server.handle
+        serialize_many = _SERIALIZER.serialize_many
+        # Replies to everything parsed in this pass are serialized into a single buffer.
+        out = bytearray()
+        while (message := reader.gets()) is not None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("parsed message: %s", message)
+
+            response = handle(message, connection)
+            if not isinstance(response, list):
+                # A blocking command: flush what is ready and resume after it completes.
+                self._write(out)
+                self._pending = asyncio.create_task(self._resume(response))
+                return
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("send messages %s", response)
+            serialize_many(response, out)
+
+        self._write(out)
+
+    async def _resume(self, response: Awaitable[list[Any]]) -> None:
+        try:
+            result = await response
+            self._pending = None
+            self._write(_SERIALIZER.serialize_many(result))
+            # Commands pipelined behind the blocking one run here, so they share the handler.
+            self._process()
+        except Exception:
+            # Same outcome as a failing synchronous command: log it and drop the connection.
+            logger.exception("Command failed on %s", self._connection.peername)
+            self._pending = None
+            self.transport.close()
+
+    def _write(self, out: bytearray) -> None:
+        if out and not self.transport.is_closing():
+            self.transport.write(out)
@@ -1,85 +1,138 @@
-import datetime
-import math
+import bisect
+import functools
+import heapq
 import time
-from typing import Any, Literal
+from typing import Any, Callable, Literal
 
 from app.exception import StreamIdOrderError, StreamIDTooLowError
+from app.redis_serde import BulkString, RedisSerializer
 from app.schemas import EntryId, StorageValue
 
+_SERIALIZER = RedisSerializer()
+_SEQUENCE_BITS = 64
+_MAX_SEQUENCE = (1 << _SEQUENCE_BITS) - 1
+_MAX_PACKED_ID = (1 << 128) - 1
 
-class Stream:
-    def __init__(self) -> None:
-        self._entries: dict = {}
-        self._last_entry = EntryId(0, 0)
 
-    def _vaidate_entry_id(self, id_: str) -> EntryId:
-        if id_ == "*":
-            timestamp, sequence_number = (time.time_ns() // 1_000_000, 0)
-        elif id_.endswith("*"):
-            timestamp = int(id_.split("-")[0])
-            if self._last_entry.timestamp == timestamp:
-                sequence_number = self._last_entry.sequence_number + 1
-            else:
-                sequence_number = 0
-        else:
-            timestamp, sequence_number = map(int, id_.split("-"))
-
-            if timestamp <= 0 and sequence_number <= 0:
-                raise StreamIDTooLowError
-
-            if (
-                timestamp < self._last_entry.timestamp
-                or timestamp == self._last_entry.timestamp
-                and sequence_number <= self._last_entry.sequence_number
-            ):
-                raise StreamIdOrderError
-        return EntryId(timestamp, sequence_number)
+def _pack_entry_id(timestamp: int, sequence_number: int) -> int:
+    # A single int orders the same way as (timestamp, sequence_number) and compares faster.
+    return timestamp << _SEQUENCE_BITS | sequence_number
+
 
-    def xadd(self, entry_id: str, value: list[str]) -> EntryId:
-        self._last_entry = self._vaidate_entry_id(entry_id)
-        self._entries[self._last_entry] = [v for v in value]
-        return self._last_entry
+def _parse_entry_id(id_: str) -> tuple[int, int]:
+    timestamp, _, sequence_number = id_.partition("-")
+    return int(timestamp), int(sequence_number)
 
-    def xrange(self, start: str, end: str) -> list[list[str]]:
-        start_key, end_key = self._make_key(start, "start"), self._make_key(end, "end")
-        return [[key, self._entries[key]] for key in self._entries if start_key <= key <= end_key]
 
-    def xread(self, entry_id: EntryId) -> list[list[str]]:
-        return [[key, self._entries[key]] for key in self._entries if key > entry_id]
+class Stream:
+    def __init__(self) -> None:
+        # Entries are stored as their serialized RESP reply, so reads only join bytes.
+        self._entries: list[bytes] = []
+        # Packed ids of the entries above. Ids only ever grow, so this list stays sorted and
+        # ranges are found by bisect.
+        self._keys: list[int] = []
+        # The last id is kept as plain ints; an EntryId is only built for callers.
+        self._last_timestamp = 0
+        self._last_sequence_number = 0
+
+    def _vaidate_entry_id(self, id_: str) -> tuple[int, int]:
+        last_timestamp = self._last_timestamp
+        last_sequence_number = self._last_sequence_number
+        if id_ == "*":
+            timestamp = time.time_ns() // 1_000_000
+            if timestamp > last_timestamp:
+                return timestamp, 0
+            return last_timestamp, last_sequence_number + 1
+
+        if id_.endswith("*"):
+            timestamp = int(id_.partition("-")[0])
+            if timestamp == last_timestamp:
+                return timestamp, last_sequence_number + 1
+            if timestamp < last_timestamp:
+                raise StreamIdOrderError
+            return timestamp, 0
+
+        timestamp, sequence_number = _parse_entry_id(id_)
+        if timestamp <= 0 and sequence_number <= 0:
+            raise StreamIDTooLowError
+        if timestamp < last_timestamp or (
+            timestamp == last_timestamp and sequence_number <= last_sequence_number
+        ):
+            raise StreamIdOrderError
+        return timestamp, sequence_number
+
+    def xadd(self, entry_id: str, value: list[BulkString]) -> EntryId:
+        timestamp, sequence_number = self._vaidate_entry_id(entry_id)
+        self._last_timestamp, self._last_sequence_number = timestamp, sequence_number
+        last_entry = EntryId(timestamp, sequence_number)
+        # The fields are parsed BulkStrings already, so they are serialized without a copy.
+        self._entries.append(_SERIALIZER.serialize([BulkString(last_entry), value]))
+        self._keys.append(_pack_entry_id(timestamp, sequence_number))
+        return last_entry
+
+    def xrange(self, start: str, end: str) -> list[bytes]:
+        keys = self._keys
+        lo = bisect.bisect_left(keys, self._make_key(start, "start"))
+        hi = bisect.bisect_right(keys, self._make_key(end, "end"))
+        return self._entries[lo:hi]
+
+    def xread(self, entry_id: EntryId) -> list[bytes]:
+        key = _pack_entry_id(entry_id.timestamp, entry_id.sequence_number)
+        return self._entries[bisect.bisect_right(self._keys, key) :]
 
     def max_key(self) -> EntryId:
-        return max(self._entries.keys())
+        return EntryId(self._last_timestamp, self._last_sequence_number)
 
     @staticmethod
-    def _make_key(key: str, position: Literal["start", "end"]) -> EntryId:
+    @functools.lru_cache(maxsize=4096)
+    def _make_key(key: str, position: Literal["start", "end"]) -> int:
         if key == "-":
-            return EntryId(0, 0)
+            return 0
         if key == "+":
-            return EntryId(math.inf, math.inf)
-        return (
-            EntryId(int(key), math.inf if position == "end" else 0)
-            if "-" not in key
-            else EntryId(*map(int, key.split("-")))
-        )
+            return _MAX_PACKED_ID
+        if "-" not in key:
+            return _pack_entry_id(int(key), _MAX_SEQUENCE if position == "end" else 0)
+        return _pack_entry_id(*_parse_entry_id(key))
 
 
 class Storage:
     def __init__(self) -> None:
         self._storage: dict[str, StorageValue] = {}
+        self._expiring: list[tuple[int, str]] = []
 
     def __setitem__(self, key: str, value: StorageValue) -> None:
         self._storage[key] = value
+        if value.expired_time is not None:
+            heapq.heappush(self._expiring, (value.expired_time, key))
+
+    def __getitem__(self, key: str, _monotonic_ns: Callable[[], int] = time.monotonic_ns) -> Any:
+        return self._get_live(key, _monotonic_ns() // 1_000_000)
+
+    def mget(self, keys: list[str]) -> list[Any]:
+        now = time.monotonic_ns() // 1_000_000
+        return [self._get_live(key, now) for key in keys]
+
+    def _get_live(self, key: str, now: int) -> Any:
+        value = self._storage.get(key)
+        if value is None:
+            return None
+        expired_time = value.expired_time
+        if expired_time is None or expired_time > now:
+            return value.value
+        del self._storage[key]
+        return None
 
-    def __getitem__(self, key: str) -> Any:
-        if key in self._storage and self._storage[key]:
-            if (
-                self._storage[key].expired_time is None
-                or self._storage[key].expired_time > datetime.datetime.now()
-            ):
-                return self._storage[key].value
-            else:
+    def remove_expired(self, now: int) -> None:
+        expiring = self._expiring
+        while expiring and expiring[0][0] <= now:
+            expired_time, key = heapq.heappop(expiring)
+            # The key may have been overwritten since this deadline was recorded.
+            value = self._storage.get(key)
+            if value is not None and value.expired_time == expired_time:
                 del self._storage[key]
-        return None
+
+    def keys(self) -> list[str]:
+        return list(self._storage)
 
     def __iter__(self) -> Any:
         return iter(self._storage)
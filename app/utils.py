@@ -1,11 +1,15 @@
+import itertools
 import random
 import string
 
+_ALPHABET = string.ascii_lowercase + string.digits
+
 
 def random_id(size: int) -> str:
-    available_values = string.ascii_lowercase + string.digits
-    return "".join(random.choice(available_values) for _ in range(size))
+    return "".join(random.choices(_ALPHABET, k=size))
 
 
 def to_pairs(values: list[str]) -> list[tuple[str, str]]:
-    return list(zip(values[: len(values) // 2], values[len(values) // 2 :]))
+    # Pairs the first half with the second (XREAD's "key1 key2 id1 id2"), without copying halves.
+    half = len(values) // 2
+    return list(zip(itertools.islice(values, half), itertools.islice(values, half, None)))
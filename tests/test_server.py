@@ -0,0 +1,47 @@
+import asyncio
+import unittest
+
+from app.server import MasterServer, RedisProtocol
+
+
+def _command(*args: bytes) -> bytes:
+    return b"*%d\r\n" % len(args) + b"".join(b"$%d\r\n%b\r\n" % (len(arg), arg) for arg in args)
+
+
+class RedisProtocolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        server = MasterServer(0)
+        loop = asyncio.get_running_loop()
+        self._listener = await loop.create_server(lambda: RedisProtocol(server), "127.0.0.1", 0)
+        port = self._listener.sockets[0].getsockname()[1]
+        self._reader, self._writer = await asyncio.open_connection("127.0.0.1", port)
+
+    async def asyncTearDown(self) -> None:
+        self._writer.close()
+        self._listener.close()
+        await self._listener.wait_closed()
+
+    async def test_command_failing_after_blocking_one_closes_connection(self) -> None:
+        self._writer.write(
+            _command(b"XREAD", b"block", b"100", b"streams", b"s", b"$")
+            + _command(b"TYPE")
+            + _command(b"PING")
+        )
+        with self.assertLogs("app.server", "ERROR"):
+            data = await asyncio.wait_for(self._reader.read(), timeout=2)
+        # The blocking reply is sent, then the connection is dropped instead of hanging.
+        self.assertEqual(data, b"*1\r\n$-1\r\n")
+
+    async def test_commands_pipelined_after_blocking_one_are_answered(self) -> None:
+        self._writer.write(
+            _command(b"XREAD", b"block", b"100", b"streams", b"s", b"$") + _command(b"PING")
+        )
+        expected = b"*1\r\n$-1\r\n+PONG\r\n"
+        data = b""
+        while len(data) < len(expected):
+            data += await asyncio.wait_for(self._reader.read(1024), timeout=2)
+        self.assertEqual(data, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
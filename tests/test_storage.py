@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+from app.exception import StreamIdOrderError
+from app.redis_serde import BulkString
+from app.schemas import EntryId, StorageValue
+from app.storage import Storage, Stream
+
+_FIELDS = [BulkString("f"), BulkString("v")]
+
+
+class StreamEntryIdTest(unittest.TestCase):
+    def test_partial_id_continues_sequence_of_same_timestamp(self) -> None:
+        stream = Stream()
+        stream.xadd("5-1", _FIELDS)
+        self.assertEqual(stream.xadd("5-*", _FIELDS), EntryId(5, 2))
+        self.assertEqual(stream.xadd("6-*", _FIELDS), EntryId(6, 0))
+
+    def test_partial_id_older_than_last_entry_is_rejected(self) -> None:
+        stream = Stream()
+        stream.xadd("5-1", _FIELDS)
+        with self.assertRaises(StreamIdOrderError):
+            stream.xadd("4-*", _FIELDS)
+        self.assertEqual(len(stream.xrange("-", "+")), 1)
+
+    def test_auto_id_stays_above_last_entry_when_clock_is_behind(self) -> None:
+        stream = Stream()
+        stream.xadd("5000-3", _FIELDS)
+        with mock.patch("app.storage.time.time_ns", return_value=4000 * 1_000_000):
+            self.assertEqual(stream.xadd("*", _FIELDS), EntryId(5000, 4))
+            self.assertEqual(stream.xadd("*", _FIELDS), EntryId(5000, 5))
+
+    def test_auto_id_uses_current_millisecond(self) -> None:
+        stream = Stream()
+        stream.xadd("5000-3", _FIELDS)
+        with mock.patch("app.storage.time.time_ns", return_value=6000 * 1_000_000):
+            self.assertEqual(stream.xadd("*", _FIELDS), EntryId(6000, 0))
+
+
+class StorageExpiryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.storage = Storage()
+        self.storage["live"] = StorageValue("a", 2000)
+        self.storage["expired"] = StorageValue("b", 1000)
+        self.storage["persistent"] = StorageValue("c", None)
+
+    def test_getitem_drops_expired_key(self) -> None:
+        def clock() -> int:
+            return 1500 * 1_000_000
+
+        self.assertEqual(self.storage.__getitem__("live", clock), "a")
+        self.assertIsNone(self.storage.__getitem__("expired", clock))
+        self.assertEqual(self.storage.keys(), ["live", "persistent"])
+
+    def test_mget_drops_expired_key(self) -> None:
+        with mock.patch("app.storage.time.monotonic_ns", return_value=1500 * 1_000_000):
+            values = self.storage.mget(["live", "expired", "missing", "persistent"])
+        self.assertEqual(values, ["a", None, None, "c"])
+        self.assertEqual(self.storage.keys(), ["live", "persistent"])
+
+
+if __name__ == "__main__":
+    unittest.main()